@@ -5,49 +5,84 @@
 #
 # Config: relay-airgradient.ini
 # All arguments are optional overrides to the config file and can occur in any order.
+# They can also be given as options, see --help.
 # Host arguments are hostnames, not URLs.
 # The variable INFLUX_TOKEN must be set in the environment.
 
 import os
+import re
 import sys
 import time
 import logging
+import gzip
 import json
+import base64
+import argparse
+import threading
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Optional
 from datetime import datetime, timedelta
 from configparser import ConfigParser
-from urllib.request import Request, urlopen
+from http.client import HTTPConnection, HTTPException, HTTPSConnection, RemoteDisconnected
 from urllib.error import HTTPError
-from urllib.parse import urlencode
+from urllib.parse import unquote, urlencode, urlsplit
+from urllib.request import getproxies, proxy_bypass
+
+# Use orjson for faster JSON handling if installed, else the standard library
+# (either way loads() accepts and dumps() returns UTF-8 bytes)
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode(UTF8_ENCODING)
 
 
 # Constants, set as desired
 LOG_LEVEL = logging.INFO
 AIRGRADIENT_TIMEOUT_SEC = 5
 INFLUX_TIMEOUT_SEC = 10
+INFLUX_BATCH_SIZE = 5000  # Max queued records sent in one write request
+INFLUX_GZIP_LEVEL = 1  # Write body compression, fastest suits small boards
+INFLUX_RETRIES = 3  # Retries of a write rejected with a transient status
+INFLUX_RETRY_BACKOFF_SEC = 0.3  # Doubled after each retry
+INFLUX_RETRY_STATUSES = (429, 500, 502, 503, 504)
+INFLUX_RETRY_DELAY_SEC = 60  # Wait before posting again after a failure
+LIGHT_RESYNC_SEC = 3600  # Resend brightness this often, in case the device restarted
 
 
-# Convert Airgradient JSON to JSON with a subset of fields (renamed)
+# Airgradient JSON fields to keep, as (original, renamed) pairs
 # Customize as desired
-def convert_data(data: dict) -> dict:
-    field_mapping = {
-        "atmpCompensated":  "temperature_c",
-        "noxIndex":         "nox_index",
-        "pm003Count":       "pm_003_ct",
-        "pm01Count":        "pm_010_ct",
-        "pm02Compensated":  "pm_025_comp",
-        "pm10Count":        "pm_100_ct",
-        "pm50Count":        "pm_050_ct",
-        "rco2":             "co2",
-        "rhumCompensated":  "humidity_pct",
-        "tvocIndex":        "tvoc_index",
-    }
+FIELD_MAPPING = (
+    ("atmpCompensated",  "temperature_c"),
+    ("noxIndex",         "nox_index"),
+    ("pm003Count",       "pm_003_ct"),
+    ("pm01Count",        "pm_010_ct"),
+    ("pm02Compensated",  "pm_025_comp"),
+    ("pm10Count",        "pm_100_ct"),
+    ("pm50Count",        "pm_050_ct"),
+    ("rco2",             "co2"),
+    ("rhumCompensated",  "humidity_pct"),
+    ("tvocIndex",        "tvoc_index"),
+)
 
-    converted = {}
-    for orig_key, new_key in field_mapping.items():
-        if orig_key in data:
-            converted[new_key] = data[orig_key]
 
-    return converted
+# Convert Airgradient JSON to JSON with a subset of fields (renamed)
+def convert_data(data: dict) -> dict:
+    try:
+        # Fast path: device reports every mapped field
+        return {new_key: data[orig_key] for orig_key, new_key in FIELD_MAPPING}
+    except KeyError:
+        return {
+            new_key: data[orig_key]
+            for orig_key, new_key in FIELD_MAPPING
+            if orig_key in data
+        }
 
 
 # No customization needed below here
@@ -57,11 +92,33 @@ UTF8_ENCODING = "utf-8"
 
 # Configure logging
 class PaddedLevelFormatter(logging.Formatter):
-    def format(self, record):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
         # Pad the levelname to 7 characters (max length of 'WARNING')
-        record.levelname = f"{record.levelname:<7}"
+        self.padded_levelnames = {
+            name: f"{name:<7}"
+            for name in ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
+        }
+        # Timestamps have 1s resolution, so format each second only once
+        self.cached_time = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if self.cached_time[0] != second:
+            self.cached_time = (second, super().formatTime(record, datefmt))
+        return self.cached_time[1]
+
+    def format(self, record):
+        record.levelname = self.padded_levelnames.get(
+            record.levelname, f"{record.levelname:<7}"
+        )
         return super().format(record)
 
+# Skip collecting record attributes the format never uses
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
 handler = logging.StreamHandler()
 handler.setFormatter(
     PaddedLevelFormatter(
@@ -88,33 +145,96 @@ class Sampling:
         self.period_sec = period_sec
 
     def is_complete(self) -> bool:
-        return all([self.location, self.num_samples, self.period_sec])
+        # Truthiness, not just presence: zero samples or period would spin run()
+        return bool(self.location and self.num_samples and self.period_sec)
+
+
+# Open a connection to host, through the proxy set in the environment
+# (http_proxy / https_proxy, honouring no_proxy) if any. Returns the connection,
+# the prefix for request paths (a plain HTTP proxy takes absolute URIs) and
+# headers to add to each request. Redirects are not followed.
+def open_connection(scheme: str, host: str, timeout: float) -> tuple:
+    connection_class = HTTPSConnection if scheme == "https" else HTTPConnection
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(host):
+        return connection_class(host, timeout=timeout), "", {}
+    proxy_url = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+    proxy_headers = {}
+    if proxy_url.username:
+        credentials = f"{unquote(proxy_url.username)}:{unquote(proxy_url.password or '')}"
+        proxy_headers["Proxy-Authorization"] = (
+            "Basic " + base64.b64encode(credentials.encode(UTF8_ENCODING)).decode("ascii")
+        )
+    logger.info("Connecting to %s via proxy %s", host, proxy_url.hostname)
+    conn = connection_class(proxy_url.hostname, proxy_url.port or 80, timeout=timeout)
+    if scheme == "https":
+        # CONNECT through the proxy, then TLS end to end with host
+        conn.set_tunnel(host, headers=proxy_headers)
+        return conn, "", {}
+    return conn, f"http://{host}", proxy_headers
+
+
+# Send a request over a server's persistent connection, returning the response
+# status, reason and body. If a kept-alive connection was dropped by the
+# server it is reopened and the request sent once more. The server's lock
+# serializes requests from different threads on the connection.
+def http_request(server, method: str, path: str, data: bytes = None) -> tuple:
+    with server.lock:
+        for attempt in range(2):
+            try:
+                server.conn.request(
+                    method, server.path_prefix + path, body=data, headers=server.headers
+                )
+                response = server.conn.getresponse()
+                return response.status, response.reason, response.read()
+            except (RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                server.conn.close()
+                if attempt:
+                    raise
+            except Exception:
+                server.conn.close()
+                raise
 
 
 # AirGradient server configuration and session
 class AirgradientServer:
     def __init__(self, host: str):
         self.host = host
-        self.headers = {"Content-Type": "application/json"}
+        # Kept alive across polls; reopened on demand after close()
+        self.conn, self.path_prefix, proxy_headers = open_connection(
+            "http", host, AIRGRADIENT_TIMEOUT_SEC
+        )
+        self.headers = {"Content-Type": "application/json", **proxy_headers}
+        self.lock = threading.Lock()
+        # (led, display) brightness last set successfully, and when (monotonic)
+        self.last_brightness = None
+        self.last_brightness_sec = None
 
 
 # Call GET http://${airgradient_host}/measures/current and return resulting JSON
 def get_airgradient(airgradient: AirgradientServer) -> dict:
-    url = f"http://{airgradient.host}/measures/current"
-    req = Request(url, headers=airgradient.headers)
-    with urlopen(req, timeout=AIRGRADIENT_TIMEOUT_SEC) as response:
-        data = response.read().decode(UTF8_ENCODING)
-        logger.debug(f"AirGradient get measure response: {data}")
-        return json.loads(data)
+    path = "/measures/current"
+    status, reason, data = http_request(airgradient, "GET", path)
+    if status >= 300:
+        raise HTTPError(f"http://{airgradient.host}{path}", status, reason, None, None)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("AirGradient get measure response: %s",
+                     data.decode(UTF8_ENCODING, errors="replace"))
+    return json_loads(data)
 
 
 # Call PUT http://${airgradient_host}/config
 def put_airgradient(airgradient: AirgradientServer, config: dict) -> bool:
-    url = f"http://{airgradient.host}/config"
-    data = json.dumps(config).encode(UTF8_ENCODING)
-    req = Request(url, data=data, headers=airgradient.headers, method='PUT')
-    with urlopen(req, timeout=AIRGRADIENT_TIMEOUT_SEC) as response:
-        response.read()  # Success if no exception raised
+    path = "/config"
+    data = json_dumps(config)
+    status, reason, _ = http_request(airgradient, "PUT", path, data)
+    if status >= 300:
+        raise HTTPError(f"http://{airgradient.host}{path}", status, reason, None, None)
+
+
+# Minutes since midnight of a time or datetime, None if unset
+def minute_of_day(t) -> Optional[int]:
+    return t.hour * 60 + t.minute if t is not None else None
 
 
 # LED / Display schedule brightness configuration
@@ -138,6 +258,18 @@ class LightSchedule:
         self.off_end = off_end
         self.disp_night_level = disp_night_level
         self.disp_day_level = disp_day_level
+        # Minutes since midnight, for cheap integer comparisons
+        self.day_start_min = minute_of_day(day_start)
+        self.day_end_min = minute_of_day(day_end)
+        self.off_start_min = minute_of_day(off_start)
+        self.off_end_min = minute_of_day(off_end)
+        # Next boundary at which brightness may change, None until first applied
+        self.next_transition = None
+
+    def is_defined(self) -> bool:
+        # Zero-length day and off windows disable the schedule
+        return self.day_start_min != self.day_end_min or \
+            self.off_start_min != self.off_end_min
 
     def __str__(self):
         # Format the light schedule as "led:LL/HHMM-HHMM/LL] [disp:LL/HHMM-HHMM/LL"
@@ -146,18 +278,42 @@ class LightSchedule:
         return f"led:{led_schedule} disp:{disp_schedule}"
 
 
+# Earliest light schedule boundary after now, before which brightness stays the same
+def next_light_transition(light_schedule: LightSchedule, now: datetime) -> datetime:
+    transitions = []
+    for boundary in (
+        light_schedule.day_start,
+        light_schedule.day_end,
+        light_schedule.off_start,
+        light_schedule.off_end,
+    ):
+        transition = datetime.combine(now.date(), boundary)
+        if transition < now:
+            transition += timedelta(days=1)
+        transitions.append(transition)
+    return min(transitions)
+
+
+# Whether brightness was last sent long enough ago that the device may have
+# restarted with its defaults since, unnoticed between two successful polls
+def brightness_resync_due(airgradient: AirgradientServer) -> bool:
+    return (
+        airgradient.last_brightness_sec is None
+        or time.monotonic() - airgradient.last_brightness_sec >= LIGHT_RESYNC_SEC
+    )
+
+
 def process_light_schedule(
     airgradient: AirgradientServer,
     light_schedule: LightSchedule,
 ):
-    now = datetime.now().time()
+    now = minute_of_day(datetime.now())
 
-    if light_schedule.day_start == light_schedule.day_end and \
-       light_schedule.off_start == light_schedule.off_end:
-        return  # No schedule defined
+    if not light_schedule.is_defined():
+        return
 
     # Determine desired brightness levels based on schedule
-    if light_schedule.day_start < now < light_schedule.day_end:
+    if light_schedule.day_start_min <= now < light_schedule.day_end_min:
         led_brightness = light_schedule.led_day_level
         disp_brightness = light_schedule.disp_day_level
     else:
@@ -165,17 +321,23 @@ def process_light_schedule(
         disp_brightness = light_schedule.disp_night_level
 
     # Override display brightness if in off window
-    if light_schedule.off_start < now < light_schedule.off_end:
+    if light_schedule.off_start_min <= now < light_schedule.off_end_min:
         disp_brightness = 0
 
-    # Send configuration (AirGradient ignores unchanged values)
+    # Send configuration only if changed since last successfully sent, or due
+    # for a periodic resync
+    if (led_brightness, disp_brightness) == airgradient.last_brightness and \
+       not brightness_resync_due(airgradient):
+        return
     config = {
         "ledBarBrightness": led_brightness,
         "displayBrightness": disp_brightness,
     }
-    logger.debug(f"Setting LED brightness to {led_brightness}%, "
-                 f"display brightness to {disp_brightness}%")
+    logger.debug("Setting LED brightness to %d%%, display brightness to %d%%",
+                 led_brightness, disp_brightness)
     put_airgradient(airgradient, config)
+    airgradient.last_brightness = (led_brightness, disp_brightness)
+    airgradient.last_brightness_sec = time.monotonic()
 
 
 # InfluxDB server configuration and session
@@ -184,60 +346,251 @@ class InfluxServer:
         self.host = host
         self.org = org
         self.bucket = bucket
-        self.headers = {"Authorization": f"Token {token}"}
+        self.headers = {
+            "Authorization": f"Token {token}",
+            "Content-Type": "text/plain; charset=utf-8",
+            "Content-Encoding": "gzip",
+        }
+        self.write_path = f"/api/v2/write?{urlencode({'bucket': bucket, 'org': org})}"
+        self.write_url = f"https://{host}{self.write_path}"
+        # Kept alive across writes; reopened on demand after close()
+        self.conn, self.path_prefix, proxy_headers = open_connection(
+            "https", host, INFLUX_TIMEOUT_SEC
+        )
+        self.headers.update(proxy_headers)
+        self.lock = threading.Lock()
+
+
+# Bounded FIFO of line protocol records (UTF-8 bytes, no trailing newline)
+# pending a post to InfluxDB, shared by the sampling loop (producer) and the
+# poster thread (consumer). Records are mirrored to a spool file so they
+# survive restarts.
+class PostQueue:
+    def __init__(self, limit: int, spool_file: str = None):
+        self.items = deque(maxlen=limit)
+        self.cond = threading.Condition()
+        self.evicted = 0  # Oldest items dropped since last peek()
+        self.spool_file = spool_file
+        # Evicted records still in the spool file, trimmed by the next rewrite.
+        # Their count is capped so the file stays bounded while posting fails.
+        self.spool_excess = 0
+        self.spool_excess_limit = max(1, limit // 10)
+        self.spool_failing = False  # Warn once per run of spool write failures
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    # Load records left in the spool file by a previous run
+    def load(self):
+        if not (self.spool_file and os.path.exists(self.spool_file)):
+            return
+        try:
+            with open(self.spool_file, "rb") as f:
+                lines = f.read().split(b"\n")
+        except OSError as e:
+            logger.warning("Error reading post queue spool: %s: %s", type(e).__name__, e)
+            return
+        # Every complete record ends in a newline, so anything after the last
+        # one is a record torn by an interrupted write
+        torn = lines.pop()
+        if torn:
+            logger.warning("Dropping incomplete last record from post queue spool: %s",
+                           torn.decode(UTF8_ENCODING, errors="replace"))
+        lines = [line for line in lines if line.strip()]
+        with self.cond:
+            self.items.extend(lines)
+            self.spool_excess = max(0, len(lines) - self.items.maxlen)
+            if torn:
+                # Remove the fragment, or the next append would extend it
+                self.rewrite_spool()
+            self.cond.notify()
+        logger.info("Loaded %d queued InfluxDB posts from %s", len(self.items), self.spool_file)
+
+    # Append a record, dropping the oldest if full
+    def put(self, item: bytes):
+        with self.cond:
+            if len(self.items) == self.items.maxlen:
+                self.evicted += 1
+                logger.warning(
+                    "Post queue exceeded limit of %d. dropped oldest item.", self.items.maxlen
+                )
+                self.spool_excess += 1
+            self.items.append(item)
+            if self.spool_excess >= self.spool_excess_limit:
+                self.rewrite_spool()
+            else:
+                self.append_spool(item)
+            self.cond.notify()
+
+    # Wait until records are queued and return up to n of the oldest
+    def peek(self, n: int) -> list:
+        with self.cond:
+            while not self.items:
+                self.cond.wait()
+            self.evicted = 0
+            return list(islice(self.items, n))
+
+    # Remove n records returned by peek(), less any evicted meanwhile
+    def remove(self, n: int):
+        with self.cond:
+            for _ in range(n - min(n, self.evicted)):
+                self.items.popleft()
+            self.evicted = 0
+            self.rewrite_spool()
+
+    # Spool file helpers, called with the lock held. Failures are logged only,
+    # the in-memory queue remains authoritative.
+    def append_spool(self, item: bytes):
+        if not self.spool_file:
+            return
+        try:
+            with open(self.spool_file, "ab") as f:
+                f.write(item + b"\n")
+                sync_file(f)
+        except OSError as e:
+            self.spool_failed(e)
+        else:
+            self.spool_succeeded()
 
+    def rewrite_spool(self):
+        self.spool_excess = 0
+        if not self.spool_file:
+            return
+        try:
+            if not self.items:
+                if os.path.exists(self.spool_file):
+                    os.remove(self.spool_file)
+                return
+            tmp_file = self.spool_file + ".tmp"
+            with open(tmp_file, "wb") as f:
+                f.writelines(item + b"\n" for item in self.items)
+                sync_file(f)
+            os.replace(tmp_file, self.spool_file)
+        except OSError as e:
+            self.spool_failed(e)
+        else:
+            self.spool_succeeded()
 
-# Global queue for pending Influx posts
-post_queue = []
-POST_QUEUE_LIMIT = 8640  # 30 days at 5-minute intervals
+    def spool_failed(self, e: OSError):
+        if self.spool_failing:
+            logger.debug("Error writing post queue spool: %s: %s", type(e).__name__, e)
+            return
+        self.spool_failing = True
+        logger.warning(
+            "Error writing post queue spool: %s: %s. Queued posts will not survive "
+            "a restart until it can be written (set queue_file in relay-airgradient.ini "
+            "to move it, or empty to disable it).", type(e).__name__, e
+        )
 
+    def spool_succeeded(self):
+        if self.spool_failing:
+            self.spool_failing = False
+            logger.info("Writing post queue spool %s again", self.spool_file)
 
-# Process Influx FIFO post queue, raising exception on first failure
-def process_post_queue(influx: InfluxServer):
-    logger.debug(f"Processing InfluxDB post queue with {len(post_queue)} items")
-    while post_queue:
-        post_data = post_queue[0]
 
-        url = f"https://{influx.host}/api/v2/write?{urlencode({'bucket': influx.bucket, 'org': influx.org})}"
-        data = post_data.encode(UTF8_ENCODING)
-        req = Request(url, data=data, headers=influx.headers, method='POST')
+# Flush a file through to disk, so its content survives a power loss
+def sync_file(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+# Global queue for pending Influx posts (oldest dropped when full)
+POST_QUEUE_LIMIT = 8640  # 30 days at 5-minute intervals
+POST_QUEUE_SPOOL_FILE = "relay-airgradient.queue"  # Default, relative to this script
+post_queue = PostQueue(POST_QUEUE_LIMIT)
+
+
+# Post a batch of line protocol records to InfluxDB, raising exception on failure.
+# A batch rejected as malformed (400) is resent in halves until the bad records
+# are isolated, so that only those are dropped.
+def write_influx(influx: InfluxServer, batch: list):
+    body = b"\n".join(batch) + b"\n"
+    data = gzip.compress(body, compresslevel=INFLUX_GZIP_LEVEL)
+
+    for attempt in range(INFLUX_RETRIES + 1):
+        status, reason, response_body = http_request(influx, "POST", influx.write_path, data)
+        if status not in INFLUX_RETRY_STATUSES or attempt == INFLUX_RETRIES:
+            break
+        delay = INFLUX_RETRY_BACKOFF_SEC * 2 ** attempt
+        logger.debug("InfluxDB returned %d %s, retrying in %.1fs", status, reason, delay)
+        time.sleep(delay)
+    logger.debug("InfluxDB response status: %d for %d items", status, len(batch))
+
+    if status == 400:
+        error = response_body.decode(UTF8_ENCODING, errors="replace")
+        if len(batch) > 1:
+            logger.warning("InfluxDB returned 400 BAD REQUEST for %d items, resending in halves: %s",
+                           len(batch), error)
+            half = len(batch) // 2
+            write_influx(influx, batch[:half])
+            write_influx(influx, batch[half:])
+        else:
+            logger.error("InfluxDB returned 400 BAD REQUEST. Dropping malformed item from queue: %s", error)
+            logger.error("Dropped item: %s", batch[0].decode(UTF8_ENCODING, errors="replace"))
+    elif status >= 300:
+        raise HTTPError(influx.write_url, status, reason, None, None)
+
 
+# Poster thread: drain the post queue in FIFO batches, retrying after failures
+def run_poster(influx: InfluxServer):
+    while True:
+        batch = post_queue.peek(INFLUX_BATCH_SIZE)
+        logger.debug("Processing InfluxDB post queue with %d items", len(post_queue))
         try:
-            with urlopen(req, timeout=INFLUX_TIMEOUT_SEC) as response:
-                status_code = response.status
-                logger.debug(f"InfluxDB response status: {status_code}")
-        except HTTPError as e:
-            if e.code == 400:
-                logger.error(f"InfluxDB returned 400 BAD REQUEST. Dropping malformed data from queue.")
-                logger.error(f"Request body: {post_data}")
-                post_queue.pop(0)
-                continue
-            else:
-                raise
+            write_influx(influx, batch)
+        except Exception as e:
+            logger.warning("Error posting to InfluxDB: %s: %s", type(e).__name__, e)
+            time.sleep(INFLUX_RETRY_DELAY_SEC)
+            continue
+        post_queue.remove(len(batch))
 
-        post_queue.pop(0)
 
+# Line protocol measurement and tag prefix shared by all points of a location
+# (tag value spaces, commas and equals signs escaped), as UTF-8 bytes
+def line_protocol_prefix(location: str) -> bytes:
+    escaped = location.replace(",", r"\,").replace("=", r"\=").replace(" ", r"\ ")
+    return f"airquality,location={escaped} ".encode(UTF8_ENCODING)
 
-# Post metrics as measurement "airquality" tagged by location to InfluxDB's v2 API
+
+# Queue metrics as a point with a line protocol prefix from
+# line_protocol_prefix() for the poster thread to send to InfluxDB's v2 API
 def post_influx(
-    influx: InfluxServer,
-    location: str,
-    timestamp: datetime,
+    line_prefix: bytes,
+    timestamp_ns: int,
     metrics: dict,
 ):
-    ts = int(timestamp.timestamp())
     values = ",".join([f"{k}={v}" for k, v in metrics.items()])
-    post_data = f"airquality,location={location} {values} {ts}000000000"
-    logger.debug(f"\n{post_data}\n")
+    post_data = line_prefix + f"{values} {timestamp_ns}".encode(UTF8_ENCODING)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("\n%s\n", post_data.decode(UTF8_ENCODING))
+    post_queue.put(post_data)
+
+
+# Whether a light schedule boundary has passed, brightness is unknown, or it
+# is due for a periodic resync
+def light_update_due(airgradient: AirgradientServer, light_schedule: LightSchedule) -> bool:
+    return light_schedule.is_defined() and (
+        light_schedule.next_transition is None
+        or datetime.now() >= light_schedule.next_transition
+        or airgradient.last_brightness is None
+        or brightness_resync_due(airgradient)
+    )
 
-    if len(post_queue) == POST_QUEUE_LIMIT:
-        post_queue.pop(0)
-        logger.warning(
-            f"Post queue exceeded limit of {POST_QUEUE_LIMIT}. dropped oldest item."
-        )
 
-    post_queue.append(post_data)
-    process_post_queue(influx)
+# Apply the light schedule, logging rather than raising errors (runs on
+# light_executor). The next transition only advances on success, so a
+# failure is retried next window.
+def update_light_schedule(airgradient: AirgradientServer, light_schedule: LightSchedule):
+    now = datetime.now()
+    try:
+        process_light_schedule(airgradient, light_schedule)
+        light_schedule.next_transition = next_light_transition(light_schedule, now)
+    except Exception as e:
+        logger.warning("Error processing light schedule: %s: %s", type(e).__name__, e)
+
+
+# Single worker, so light schedule updates apply in order
+light_executor = ThreadPoolExecutor(max_workers=1)
 
 
 #############################################################################
@@ -249,63 +602,62 @@ def run(
     sampling: Sampling,
     light_schedule: LightSchedule,
 ):
-    # Target time for first sample
-    next_sample_time = datetime.now()
+    # Sample deadlines sit on a fixed grid of the monotonic clock, so wall
+    # clock adjustments (NTP, DST) neither accumulate drift nor cause slips
+    next_deadline = time.monotonic()
+    line_prefix = line_protocol_prefix(sampling.location)
 
     while True:
-        # Collect n samples
-        samples = []
-        window_start_time = next_sample_time
+        # Collect n samples, accumulating per-field sums and counts
+        sums = defaultdict(float)
+        counts = defaultdict(int)
         for i in range(sampling.num_samples):
             # Sleep until target time for this sample
-            now = datetime.now()
-            sleep_time = max(0, (next_sample_time - now).total_seconds())
-            logger.debug(
-                f"Sleeping for {sleep_time:.2f} seconds before sample {i + 1}/{sampling.num_samples}"
-            )
+            sleep_time = next_deadline - time.monotonic()
             if sleep_time > 0:
+                logger.debug(
+                    "Sleeping for %.2f seconds before sample %d/%d",
+                    sleep_time, i + 1, sampling.num_samples,
+                )
                 time.sleep(sleep_time)
-            elif sleep_time < 0:
-                logger.warning(f"Sampling slipped by {-sleep_time:.2f}s")
-                next_sample_time = now
+
+            # Wall clock is only used for the InfluxDB timestamp
+            if i == 0:
+                window_start_ns = time.time_ns()
 
             try:
                 data = get_airgradient(airgradient)
-                converted = convert_data(data)
-                if converted:
-                    samples.append(converted)
+                for key, value in convert_data(data).items():
+                    sums[key] += value
+                    counts[key] += 1
+            except (OSError, HTTPException) as e:
+                logger.warning("Error collecting sample: %s: %s", type(e).__name__, e)
+                # Device may be restarting, resend brightness once it is back
+                airgradient.last_brightness = None
             except Exception as e:
-                logger.warning(f"Error collecting sample: {type(e).__name__}: {e}")
-
-            # Process light schedule after first sample
-            if i == 0:
-                try:
-                    process_light_schedule(airgradient, light_schedule)
-                except Exception as e:
-                    logger.warning(f"Error processing light schedule: {type(e).__name__}: {e}")
-
-            # Set target time for next sample
-            next_sample_time += timedelta(seconds=sampling.period_sec)
-
-        if samples and samples[0].keys():
-            window_center_time = window_start_time + timedelta(
-                seconds=sampling.period_sec * sampling.num_samples / 2
+                logger.warning("Error collecting sample: %s: %s", type(e).__name__, e)
+
+            # Update light schedule after first sample, in the background so
+            # the PUT overlaps the sleep until the next sample
+            if i == 0 and light_update_due(airgradient, light_schedule):
+                light_executor.submit(update_light_schedule, airgradient, light_schedule)
+
+            # Set target time for next sample, skipping whole periods if behind
+            next_deadline += sampling.period_sec
+            now = time.monotonic()
+            if next_deadline < now:
+                logger.warning("Sampling slipped by %.2fs", now - next_deadline)
+                while next_deadline < now:
+                    next_deadline += sampling.period_sec
+
+        if sums:
+            window_center_ns = window_start_ns + int(
+                sampling.period_sec * sampling.num_samples * 500_000_000
             )
-            averaged_data = {}
-            for key in samples[0].keys():
-                values = [s[key] for s in samples if key in s]
-                averaged_data[key] = round(sum(values) / len(values), 2)
-
-            if averaged_data:
-                try:
-                    post_influx(
-                        influx,
-                        sampling.location,
-                        window_center_time,
-                        averaged_data,
-                    )
-                except Exception as e:
-                    logger.warning(f"Error posting to InfluxDB: {type(e).__name__}: {e}")
+            averaged_data = {
+                key: round(total / counts[key], 2) for key, total in sums.items()
+            }
+            post_influx(line_prefix, window_center_ns, averaged_data)
         else:
             logger.warning("No samples collected; posting to InfluxDB skipped.")
 
@@ -350,6 +702,61 @@ def parse_light_schedule(schedule_str: str) -> tuple:
         return None
 
 
+INFLUX_ARG_RE = re.compile(r"^([^/]+)/([^/]+)/([^/]+)$")
+SAMPLING_ARG_RE = re.compile(r"^(\d+)\*(\d+)$")
+# Original "<prefix>:<value>" argument forms and their options
+PREFIXED_ARGS = {"loc": "--loc", "led": "--led", "disp": "--disp"}
+VALUE_OPTIONS = ("--influx", "--airgradient", "--loc", "--sampling", "--led", "--disp")
+
+
+# argparse types for the command-line options
+def influx_arg(value: str) -> tuple:
+    match = INFLUX_ARG_RE.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"expected <host>/<org>/<bucket>, got '{value}'")
+    return match.groups()
+
+
+def nonempty_arg(value: str) -> str:
+    if not value:
+        raise argparse.ArgumentTypeError("expected a value, got ''")
+    return value
+
+
+def sampling_arg(value: str) -> tuple:
+    match = SAMPLING_ARG_RE.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"expected <n*period_sec>, got '{value}'")
+    return int(match.group(1)), int(match.group(2))
+
+
+def light_schedule_arg(value: str) -> tuple:
+    schedule = parse_light_schedule(value)
+    if not schedule:
+        raise argparse.ArgumentTypeError(f"expected LL/HHMM-HHMM/LL, got '{value}'")
+    return schedule
+
+
+# Rewrite the original positional argument forms (e.g., "loc:bedroom", "5*60")
+# as the equivalent options, leaving options as they are
+def normalize_args(args: list) -> list:
+    normalized = []
+    for arg in args:
+        prefix, colon, value = arg.partition(":")
+        if arg.startswith("-") or (normalized and normalized[-1] in VALUE_OPTIONS):
+            normalized.append(arg)
+        elif colon and prefix in PREFIXED_ARGS:
+            normalized.append(f"{PREFIXED_ARGS[prefix]}={value}")
+        elif "*" in arg:
+            # Malformed counts are left to sampling_arg() to report
+            normalized.append(f"--sampling={arg}")
+        elif "/" in arg:
+            normalized.append(f"--influx={arg}")
+        else:
+            normalized.append(f"--airgradient={arg}")
+    return normalized
+
+
 # Extract / check args and call run()
 def main():
     usage_str = (
@@ -357,6 +764,20 @@ def main():
         + " [<influx_host>/<influx_org>/<influx_bucket>] [<airgradient_host>] [loc:<location>] [<n*period_sec>] [led:LL/HHMM-HHMM/LL] [disp:LL/HHMM-HHMM/LL]"
     )
 
+    parser = argparse.ArgumentParser(
+        usage=usage_str,
+        allow_abbrev=False,
+        description="Relay AirGradient measurements to InfluxDB. Arguments "
+        "override relay-airgradient.ini and may also be given as options.",
+    )
+    parser.add_argument("--influx", type=influx_arg, metavar="HOST/ORG/BUCKET")
+    parser.add_argument("--airgradient", type=nonempty_arg, metavar="HOST")
+    parser.add_argument("--loc", type=nonempty_arg, metavar="LOCATION")
+    parser.add_argument("--sampling", type=sampling_arg, metavar="N*PERIOD_SEC")
+    parser.add_argument("--led", type=light_schedule_arg, metavar="LL/HHMM-HHMM/LL")
+    parser.add_argument("--disp", type=light_schedule_arg, metavar="LL/HHMM-HHMM/LL")
+    args = parser.parse_args(normalize_args(sys.argv[1:]))
+
     influx_token = os.environ.get("INFLUX_TOKEN")
     if not influx_token:
         logger.error("Error: INFLUX_TOKEN environment variable not set")
@@ -377,6 +798,10 @@ def main():
         num_samples=config.getint("sampling", "num_samples", fallback=None),
         period_sec=config.getint("sampling", "period_sec", fallback=None),
     )
+    # Post queue spool file: empty disables it, relative paths are from this script
+    queue_file = config.get("sampling", "queue_file", fallback=POST_QUEUE_SPOOL_FILE)
+    if queue_file:
+        post_queue.spool_file = os.path.join(os.path.dirname(__file__), queue_file)
 
     # LED / display schedule - initialize from config file
     led_schedule = None
@@ -394,40 +819,30 @@ def main():
             disp_night = config.getint("light_schedule", "disp_level_night", fallback=None)
             disp_day = config.getint("light_schedule", "disp_level_day", fallback=None)
 
-            if all([day_start, day_end, led_night is not None, led_day is not None]):
+            if day_start and day_end and led_night is not None and led_day is not None:
                 led_schedule = parse_light_schedule(
                     f"{led_night}/{day_start}-{day_end}/{led_day}"
                 )
-            if all([off_start, off_end, disp_night is not None, disp_day is not None]):
+            if off_start and off_end and disp_night is not None and disp_day is not None:
                 disp_schedule = parse_light_schedule(
                     f"{disp_night}/{off_start}-{off_end}/{disp_day}"
                 )
         except (ValueError, AttributeError) as e:
-            logger.warning(f"Error parsing light schedule from config file: {e}")
+            logger.warning("Error parsing light schedule from config file: %s", e)
 
     # Override with command-line arguments
-    args = sys.argv[1:]
-
-    for arg in args:
-        if "/" in arg and ":" not in arg:
-            parts = arg.split("/")
-            if len(parts) == 3:
-                influx_host = parts[0]
-                influx_org = parts[1]
-                influx_bucket = parts[2]
-        elif "*" in arg:
-            parts = arg.split("*")
-            if len(parts) == 2 and parts[0].isdigit() and parts[1].isdigit():
-                sampling.num_samples = int(parts[0])
-                sampling.period_sec = int(parts[1])
-        elif arg.startswith("loc:"):
-            sampling.location = arg[4:]
-        elif arg.startswith("led:"):
-            led_schedule = parse_light_schedule(arg[4:])
-        elif arg.startswith("disp:"):
-            disp_schedule = parse_light_schedule(arg[5:])
-        else:
-            airgradient_host = arg
+    if args.influx:
+        influx_host, influx_org, influx_bucket = args.influx
+    if args.airgradient:
+        airgradient_host = args.airgradient
+    if args.loc:
+        sampling.location = args.loc
+    if args.sampling:
+        sampling.num_samples, sampling.period_sec = args.sampling
+    if args.led:
+        led_schedule = args.led
+    if args.disp:
+        disp_schedule = args.disp
 
     if led_schedule and disp_schedule:
         light_schedule = LightSchedule(
@@ -442,25 +857,31 @@ def main():
         )
 
     if not (
-        all([influx_host, influx_org, influx_bucket, airgradient_host, light_schedule])
+        influx_host
+        and influx_org
+        and influx_bucket
+        and airgradient_host
+        and light_schedule
         and sampling.is_complete()
     ):
         logger.error("Error: Missing or invalid arguments")
         logger.error("Check that relay-airgradient.ini is present in same directory as this script and/or optional command-line arguments are correct.")
-        logger.error(f"Usage: {usage_str}")
+        logger.error("Usage: %s", usage_str)
         sys.exit(1)
 
     influx = InfluxServer(influx_host, influx_org, influx_bucket, influx_token)
     airgradient = AirgradientServer(airgradient_host)
 
     logger.info(
-        f"Polling data from '{airgradient_host}' every {sampling.period_sec} seconds, "
-        f"averaging over {sampling.num_samples} samples and posting for location "
-        f"'{sampling.location}' to InfluxDB at {influx_host} (org '{influx_org}', bucket "
-        f"'{influx_bucket}')."
+        "Polling data from '%s' every %s seconds, averaging over %d samples and "
+        "posting for location '%s' to InfluxDB at %s (org '%s', bucket '%s').",
+        airgradient_host, sampling.period_sec, sampling.num_samples,
+        sampling.location, influx_host, influx_org, influx_bucket,
     )
-    logger.info(f"Light schedule: {light_schedule}")
+    logger.info("Light schedule: %s", light_schedule)
 
+    post_queue.load()
+    threading.Thread(target=run_poster, args=(influx,), daemon=True).start()
     run(
         airgradient,
         influx,